@@ -1,17 +1,19 @@
 from iminuit import Minuit
 import numpy as np
 import pandas as pd
+from scipy.special import gammaln
 
-from copy import deepcopy
+from copy import copy
+from math import asin, atan2, ceil, cos, floor, hypot, log2, pi, sin, sqrt
 
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.colors import BoundaryNorm
-from matplotlib.ticker import MaxNLocator
+try:
+    import numba
+except ImportError:  # fall back to the NumPy implementation of the Monte Carlo
+    numba = None
 
-from IPython.display import clear_output
+# matplotlib and IPython are only imported by the plotting methods, so that the
+# simulation can run without them (e.g. in worker processes)
 
-np.random.seed(12345)
 inch = 25.4  # mm
 
 
@@ -28,13 +30,54 @@ class GeoParameters:
         self.r_sipm = r_sipm  # mm
         self.a_sipm = np.pi * r_sipm ** 2
         self.sipms = []
+        # SiPM arrays are rebuilt when needed after a SiPM was added
+        self._arrays_dirty = True
 
     def add_sipm(self, sipm):
         self.sipms.append(sipm)
+        self._arrays_dirty = True
 
     def get_sipms(self):
         return self.sipms
 
+    def _update_arrays(self):
+        if self._arrays_dirty:
+            self._xyz = np.array([sipm.get_location() for sipm in self.sipms], dtype=np.float64).reshape(-1, 3)
+            self._nhat = np.array([sipm.get_normal_vector() for sipm in self.sipms], dtype=np.float64).reshape(-1, 3)
+            self._qe = np.array([sipm.get_qe() for sipm in self.sipms], dtype=np.float64)
+            self._is_plane = np.array([sipm.get_type() == "plane" for sipm in self.sipms], dtype=bool)
+            self._arrays_dirty = False
+
+    def update_arrays(self):
+        """Rebuild the SiPM arrays, e.g. after a SiPM was moved with set_phi_z or set_xyz.
+        Called once by Simulator.generate_events, the reconstruction uses the arrays of that simulation"""
+        self._arrays_dirty = True
+        self._update_arrays()
+
+    @property
+    def xyz(self):
+        """(M,3) array with the SiPM locations"""
+        self._update_arrays()
+        return self._xyz
+
+    @property
+    def nhat(self):
+        """(M,3) array with the SiPM normal vectors"""
+        self._update_arrays()
+        return self._nhat
+
+    @property
+    def qe(self):
+        """(M,) array with the SiPM quantum efficiencies"""
+        self._update_arrays()
+        return self._qe
+
+    @property
+    def is_plane(self):
+        """(M,) boolean array, True for the SiPMs in the plane"""
+        self._update_arrays()
+        return self._is_plane
+
     def __copy__(self):
         G = GeoParameters(self.z_plane, self.r_cylinder, self.r_sipm)
         for sipm in self.sipms:
@@ -58,12 +101,18 @@ class SiPM:
             self.rhat = [0,0,-1]
         elif type == "cylinder":
             # pointing inward
-            self.rhat = [-position[0],-position[1],0]
-            self.rhat = self.rhat / np.linalg.norm(self.rhat)
+            self.rhat = np.array([-position[0],-position[1],0]) / hypot(position[0], position[1])
         self.nhit = 0
         self.hit_probability = 0
         self.qe = qeff
 
+    def __copy__(self):
+        S = SiPM.__new__(SiPM)
+        S.__dict__.update(self.__dict__)
+        # set_phi_z changes the position in place
+        S.x = copy(self.x)
+        return S
+
     def get_qe(self):
         return self.qe
 
@@ -83,13 +132,12 @@ class SiPM:
     def set_phi_z(self, r, phi, z):
         # for the SiPMs on a cylinder
         self.type = "cylinder"
-        self.x[0] = r * np.cos(phi)
-        self.x[1] = r * np.sin(phi)
+        self.x[0] = r * cos(phi)
+        self.x[1] = r * sin(phi)
         self.x[2] = z
 
         # pointing inward
-        self.rhat = [-self.x[0], -self.x[1], 0]
-        self.rhat = self.rhat / np.linalg.norm(self.rhat)
+        self.rhat = np.array([-self.x[0], -self.x[1], 0]) / hypot(self.x[0], self.x[1])
 
     def set_xyz(self, x):
         self.type = "plane"
@@ -110,23 +158,160 @@ class SiPM:
     def set_number_of_hits(self, n):
         self.nhit = n
 
+# -----------------------------------------------------------------------------------#
+class SiPMGrid:
+    """ Coarse grid over the SiPM surfaces, used to hit-test a photon only against
+        the SiPMs close to its intersection point.
+
+        Surface 0 is the plane with cell coordinates (x, y), surface 1 is the cylinder
+        with cell coordinates (r_cylinder * phi, z). A SiPM is listed in every cell that
+        contains a point closer than r_sipm to it.
+    """
+
+    def __init__(self, geo):
+        xyz = geo.xyz
+        is_plane = geo.is_plane
+        self.r_cylinder = geo.r_cylinder
+        r_sipm = geo.r_sipm
+        cell = 4 * r_sipm
+
+        # (u0, v0, du, dv) and (nu, nv, first cell) of each surface
+        self.par = np.ones((2, 4))
+        self.shape = np.zeros((2, 3), dtype=np.int64)
+
+        # half width of the region around a SiPM that can contain a hit
+        # (for the cylinder in the same units of arc length as r_cylinder * phi)
+        h_u = (r_sipm, self.r_cylinder * asin(min(1., r_sipm / self.r_cylinder)))
+
+        cells = []
+        sipms = []
+        n_cell = 0
+        for k, mask in enumerate((is_plane, ~is_plane)):
+            index = np.flatnonzero(mask)
+            self.shape[k, 2] = n_cell
+            if len(index) == 0:
+                continue
+            u, v = self.surface_coordinates(k, xyz[index])
+
+            if k == 0:
+                u0 = u.min() - h_u[k]
+                nu = int(ceil((u.max() + h_u[k] - u0) / cell))
+                du = cell
+            else:
+                # periodic in phi
+                u0 = -np.pi * self.r_cylinder
+                nu = max(1, int(2 * np.pi * self.r_cylinder / cell))
+                du = 2 * np.pi * self.r_cylinder / nu
+            v0 = v.min() - r_sipm
+            nv = int(ceil((v.max() + r_sipm - v0) / cell))
+            dv = cell
+
+            self.par[k] = (u0, v0, du, dv)
+            self.shape[k, :2] = (nu, nv)
+
+            for j, uj, vj in zip(index, u, v):
+                iu = np.arange(floor((uj - h_u[k] - u0) / du), floor((uj + h_u[k] - u0) / du) + 1)
+                iv = np.arange(floor((vj - r_sipm - v0) / dv), floor((vj + r_sipm - v0) / dv) + 1)
+                if k == 0:
+                    iu = np.clip(iu, 0, nu - 1)
+                else:
+                    iu = np.mod(iu, nu)
+                iv = np.clip(iv, 0, nv - 1)
+                c = np.unique(n_cell + np.add.outer(iu * nv, iv).ravel()).astype(np.int64)
+                cells.append(c)
+                sipms.append(np.full(len(c), j, dtype=np.int64))
+
+            n_cell = n_cell + nu * nv
+
+        cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+        sipms = np.concatenate(sipms) if sipms else np.zeros(0, dtype=np.int64)
+
+        # SiPMs of cell c are cell_sipm[cell_start[c]:cell_start[c+1]]
+        self.cell_sipm = sipms[np.argsort(cells, kind='stable')]
+        self.cell_start = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=n_cell)))).astype(np.int64)
+
+    def surface_coordinates(self, k, x):
+        """ Grid coordinates (u, v) of (N,3) points x on surface k """
+        if k == 0:
+            return x[:, 0], x[:, 1]
+        return self.r_cylinder * np.arctan2(x[:, 1], x[:, 0]), x[:, 2]
+
+    def locate(self, k, x):
+        """ Return the indices of the points x inside the grid of surface k and their cells """
+        u0, v0, du, dv = self.par[k]
+        nu, nv, first = self.shape[k]
+        u, v = self.surface_coordinates(k, x)
+
+        with np.errstate(invalid='ignore'):
+            fu = (u - u0) / du
+            fv = (v - v0) / dv
+            inside = (fv >= 0) & (fv < nv)
+            if k == 0:
+                inside = inside & (fu >= 0) & (fu < nu)
+            else:
+                inside = inside & np.isfinite(fu)
+
+        index = np.flatnonzero(inside)
+        iu = np.floor(fu[index]).astype(np.int64) % max(1, nu)
+        iv = fv[index].astype(np.int64)
+        return index, first + iu * nv + iv
+
+    def candidates(self, k, x):
+        """ Return all (point, SiPM) pairs for which the point x on surface k
+            lies in a cell listing the SiPM """
+        index, cell = self.locate(k, x)
+        start = self.cell_start[cell]
+        count = self.cell_start[cell + 1] - start
+
+        point = np.repeat(index, count)
+        offset = np.arange(len(point)) - np.repeat(np.cumsum(count) - count, count)
+        return point, self.cell_sipm[np.repeat(start, count) + offset]
+
 # -----------------------------------------------------------------------------------#
 class Simulator:
     """Simulation of SiPM acceptance"""
 
-    def __init__(self, geo, uv_position, n_mc):
+    def __init__(self, geo, uv_position, n_mc, **kwargs):
         self.n_mc = n_mc
-
-        self.cost_range = [np.cos(0), np.cos(np.pi)]
-        self.phi_range = [0, 2 * np.pi]
+        # photon Monte Carlo implementation: "numba", "numpy" or "cuda" (GPU, for very large n_mc)
+        self.backend = kwargs.pop('backend', 'numpy' if numba is None else 'numba')
+        if self.backend == "cuda" and not _cuda_available():
+            print("Simulator::__init__ ERROR no CUDA GPU available. Use backend = numba")
+            self.backend = "numba"
+        if self.backend == "numba" and numba is None:
+            print("Simulator::__init__ ERROR numba is not available. Use backend = numpy")
+            self.backend = "numpy"
+        elif self.backend not in ("numba", "numpy", "cuda"):
+            print("Simulator::__init__ ERROR wrong backend selected. backend =", self.backend)
+            self.backend = "numpy"
+        # photon directions: "random" (pseudo-random) or "sobol" (quasi-random)
+        self.sampler = kwargs.pop('sampler', 'random')
+        if self.sampler not in ("random", "sobol"):
+            print("Simulator::__init__ ERROR wrong sampler selected. sampler =", self.sampler)
+            self.sampler = "random"
+        elif self.sampler == "sobol" and self.backend == "cuda":
+            print("Simulator::__init__ ERROR sampler = sobol not available for backend = cuda. Use sampler = random")
+            self.sampler = "random"
+
+        self.cost_range = [cos(0), cos(pi)]
+        self.phi_range = [0, 2 * pi]
         # x0 of the UV photons
-        self.x0 = np.array(uv_position)
-        self.tdir = np.zeros(3)
+        self.x0 = np.array(uv_position, dtype=np.float64)
+        # random number generator for the photon directions (seed = None: not reproducible)
+        self.rng = np.random.default_rng(kwargs.pop('seed', None))
 
         self.h_cost, self.h_cost_bins = np.histogram([], bins=1000, range=[-1.1, 1.1])
-        self.h_cost_tmp = []
-        # in order to alllocate new memory locations for lists inside geometry
-        self.geo = deepcopy(geo)
+        # in order to alllocate new memory locations for the SiPMs inside geometry
+        self.geo = GeoParameters(geo.z_plane, geo.r_cylinder, geo.r_sipm)
+        for sipm in geo.get_sipms():
+            self.geo.add_sipm(copy(sipm))
+
+        # constants of the photon - cylinder quadratic equation A s^2 + B s + C = 0
+        self._tx = 2 * self.x0[0]
+        self._ty = 2 * self.x0[1]
+        self._c_cylinder = self.x0[0] ** 2 + self.x0[1] ** 2 - self.geo.r_cylinder ** 2
+        # a photon hits a SiPM if its squared distance to the SiPM is below r_sipm^2
+        self._r_sipm_sq = self.geo.r_sipm ** 2
 
     def get_x0(self):
         return self.x0
@@ -153,15 +338,31 @@ class Simulator:
 
             NOTE: It is assumed that all SiPMs are either located on the surface of the cylinder or in the plane
         """
-        for sipm in self.geo.get_sipms():
-            sipm.nhit = 0
-        # n_mc events are generated
-        for i in range(self.n_mc):
-            if i % 100000 == 0:
-                print("generated ", i, " events")
-                self.fill_hist()
-
-            # generate a single UV photon
+        self.geo.update_arrays()
+        self.grid = SiPMGrid(self.geo)
+        # n_mc events are generated in one go
+        print("generate ", self.n_mc, " events")
+
+        if self.backend == "cuda":
+            # the UV photons are generated, intersected and hit-tested on the GPU
+            self.set_hits(self.simulate_gpu())
+            self.n_generated = self.n_mc
+        elif self.backend == "numba" and self.sampler == "random":
+            # the UV photons are generated, intersected and hit-tested in a single compiled pass
+            self.set_hits(self.simulate_cpu())
+            self.n_generated = self.n_mc
+        elif self.backend == "numba":
+            # generate the UV photons
+            self.generate_uv()
+
+            # intersect and hit-test all photons in a single compiled pass
+            nhit = np.zeros((numba.get_num_threads(), len(self.geo.xyz)), dtype=np.int64)
+            _simulate(self.tdir, self.x0, self.geo.z_plane, self.geo.r_cylinder,
+                      self._tx, self._ty, self._c_cylinder, self._r_sipm_sq, self.geo.xyz,
+                      self.grid.par, self.grid.shape, self.grid.cell_start, self.grid.cell_sipm, nhit)
+            self.set_hits(nhit.sum(axis=0))
+        else:
+            # generate the UV photons
             self.generate_uv()
 
             # intersect with plane
@@ -170,101 +371,325 @@ class Simulator:
             s_cylinder = self.intersect_with_cylinder()
 
             # coordinates of intersection with plane
-            self.xint_plane = self.x0 + np.multiply(s_plane, self.tdir)
+            self.xint_plane = self.x0 + s_plane[:, None] * self.tdir
             # coordinates of intersection with cylinder
-            self.xint_cylinder = self.x0 + np.multiply(s_cylinder, self.tdir)
+            self.xint_cylinder = self.x0 + s_cylinder[:, None] * self.tdir
 
-            # check if the UV photon hits a SiPM
-            for sipm in self.geo.get_sipms():
-                self.hit_sipm(sipm)
+            # check if the UV photons hit a SiPM
+            self.hit_sipms()
 
         # calculate the hit probabilities
         for sipm in self.geo.get_sipms():
-            p = sipm.get_number_of_hits() / self.n_mc
+            p = sipm.get_number_of_hits() / self.n_generated
             # correct for the quantum efficiency
             p = p * sipm.qe
             sipm.set_hit_probability(p)
 
         self.Print()
-        self.fill_hist()
         print("event generation done")
 
-    def fill_hist(self):
-        # cos theta distribution
-        htemp, dummy = np.histogram(self.h_cost_tmp, bins=1000, range=[-1.1, 1.1])
-        self.h_cost = self.h_cost + htemp
-        self.h_cost_tmp = []
-
     def generate_uv(self):
-        """ Generate a UV photon with random direction. The starting position
-            of the photon is always the same (within this class)
-        """
-        cost = np.random.uniform(self.cost_range[0], self.cost_range[1])
-        sint = np.sqrt(1 - cost ** 2)
-        phi = np.random.uniform(self.phi_range[0], self.phi_range[1])
-        self.tdir = [np.cos(phi) * sint, np.sin(phi) * sint, cost]
-        # histogramming
-        self.h_cost_tmp.append(self.tdir[2])
-
-    def hit_sipm(self, sipm):
-        """ Calculate whether a track hits a SiPM.
-            If the SiPM is hit the number of hits is incremented.
+        """ Generate n_mc UV photons with random direction. The starting position
+            of the photons is always the same (within this class)
+
+            The directions are stored as an (n_mc,3) array in self.tdir. With the
+            sobol sampler n_mc is rounded up to a power of 2, the number of photons
+            is stored in self.n_generated
+
+            Only used by the numpy backend and the sobol sampler, the numba backend
+            draws its random directions inside the kernel (see simulate_cpu)
         """
-        x = [0, 0, 0]
-        if sipm.get_type() == "plane":
-            x = self.xint_plane
-        elif sipm.get_type() == "cylinder":
-            x = self.xint_cylinder
+        cost_min, cost_max = min(self.cost_range), max(self.cost_range)
+        if self.sampler == "sobol":
+            # scipy.stats is slow to import and only needed here
+            from scipy.stats import qmc
+
+            # Sobol points keep their balance properties only for 2^m points
+            m = max(0, ceil(log2(self.n_mc)))
+            u = qmc.Sobol(d=2, scramble=True, seed=self.rng).random_base2(m)
+            cost = cost_min + (cost_max - cost_min) * u[:, 0]
+            phi = self.phi_range[0] + (self.phi_range[1] - self.phi_range[0]) * u[:, 1]
         else:
-            print("Simulator::hit_sipm ERROR wrong sipm type found. sipm.get_type() =", sipm.get_type())
+            # Generator.uniform needs low <= high: cost_range runs from cos(0) down to cos(pi)
+            cost = self.rng.uniform(cost_min, cost_max, size=self.n_mc)
+            phi = self.rng.uniform(self.phi_range[0], self.phi_range[1], size=self.n_mc)
+        sint = np.sqrt(1 - cost * cost)
+        self.tdir = np.stack([np.cos(phi) * sint, np.sin(phi) * sint, cost], axis=1)
+        self.n_generated = len(cost)
+        # histogramming of the cos theta distribution
+        self.h_cost = self.h_cost + np.histogram(cost, bins=self.h_cost_bins)[0]
+
+    def hit_sipms(self):
+        """ Calculate how many tracks hit each SiPM.
+            The number of hits of every SiPM is set accordingly.
+
+            Only the SiPMs listed in the grid cell in which a photon ends are tested.
+        """
+        nhit = np.zeros(len(self.geo.xyz), dtype=np.int64)
+        r2 = self._r_sipm_sq
 
-        dx = np.linalg.norm(x - sipm.get_location())
-        if dx < self.geo.r_sipm:
-            sipm.nhit = sipm.nhit + 1
+        for surface, xint in enumerate((self.xint_plane, self.xint_cylinder)):
+            photon, sipm = self.grid.candidates(surface, xint)
+            delta = xint[photon] - self.geo.xyz[sipm]
+            d2 = np.einsum('ij,ij->i', delta, delta)
+            nhit = nhit + np.bincount(sipm[d2 < r2], minlength=len(nhit))
 
-    def intersect_with_cylinder(self):
-        """ calculate intersect of UV photon with cylinder -
-            Return the positive path length s+ """
-        s = 0
+        self.set_hits(nhit)
+
+    def simulate_cpu(self, n_chunk=256):
+        """ Generate the UV photons with numba and count the hits of every SiPM.
 
-        A = self.tdir[0] ** 2 + self.tdir[1] ** 2
-        B = 2 * (self.x0[0] * self.tdir[0] + self.x0[1] * self.tdir[1])
-        C = self.x0[0] ** 2 + self.x0[1] ** 2 - self.geo.r_cylinder ** 2
+            The photons are generated in n_chunk chunks, each with its own seed drawn
+            from self.rng. tdir is not filled, the cos theta histogram is.
+        """
+        seeds = self.rng.integers(2 ** 32, size=n_chunk)
+        nhit = np.zeros((n_chunk, len(self.geo.xyz)), dtype=np.int64)
+        h_cost = np.zeros((n_chunk, len(self.h_cost)), dtype=np.int64)
+        _simulate_random(self.n_mc, seeds, min(self.cost_range), max(self.cost_range),
+                         self.phi_range[0], self.phi_range[1], self.x0, self.geo.z_plane, self.geo.r_cylinder,
+                         self._tx, self._ty, self._c_cylinder, self._r_sipm_sq, self.geo.xyz,
+                         self.grid.par, self.grid.shape, self.grid.cell_start, self.grid.cell_sipm,
+                         nhit, h_cost, self.h_cost_bins[0], self.h_cost_bins[1] - self.h_cost_bins[0])
+        self.h_cost = self.h_cost + h_cost.sum(axis=0)
+        return nhit.sum(axis=0)
+
+    def simulate_gpu(self):
+        """ Generate the UV photons on the GPU and count the hits of every SiPM.
+
+            The photon directions only exist on the device, so tdir and the
+            cos theta histogram are not filled.
+        """
+        from numba import cuda
+        from numba.cuda.random import create_xoroshiro128p_states
+
+        if self.n_mc == 0:
+            return np.zeros(len(self.geo.xyz), dtype=np.int64)
+
+        threads = 256
+        blocks = min((self.n_mc + threads - 1) // threads, 4096)
+        # one random number stream for each GPU thread
+        rng_states = create_xoroshiro128p_states(blocks * threads, seed=int(self.rng.integers(2 ** 63)))
+
+        nhit = cuda.to_device(np.zeros(len(self.geo.xyz), dtype=np.int64))
+        simulate = _cuda_kernel()
+        simulate[blocks, threads](self.n_mc, self.x0, self.geo.z_plane,
+                                  min(self.cost_range), max(self.cost_range), self.phi_range[0], self.phi_range[1],
+                                  self._tx, self._ty, self._c_cylinder, self._r_sipm_sq,
+                                  cuda.to_device(self.geo.xyz), cuda.to_device(self.geo.is_plane),
+                                  nhit, rng_states)
+        return nhit.copy_to_host()
+
+    def set_hits(self, nhit):
+        """ Set the number of hits of every SiPM from an array of length M """
+        for sipm, n in zip(self.geo.get_sipms(), nhit):
+            sipm.nhit = int(n)
 
-        # print("tdir = ",self.tdir, " |tdir|=",np.linalg.norm(self.tdir))
-        # print("x0   = ",self.x0, " |x0|=",np.linalg.norm(self.x0))
-        # print("Rcyl = ",self.geo.r_cylinder," A =",A," B=",B," C=",C," B2-4AC =",B**2-4*A*C)
+    def intersect_with_cylinder(self):
+        """ calculate intersect of UV photons with cylinder -
+            Return the positive path lengths s+ (0 if there is no intersection) """
+        A = self.tdir[:, 0] ** 2 + self.tdir[:, 1] ** 2
+        B = self._tx * self.tdir[:, 0] + self._ty * self.tdir[:, 1]
 
-        discriminant = B ** 2 - 4 * A * C;
+        discriminant = B * B - 4 * A * self._c_cylinder
 
-        if discriminant >= 0:
-            s0 = (-B + np.sqrt(discriminant)) / (2 * A)
-            s1 = (-B - np.sqrt(discriminant)) / (2 * A)
+        # A > 0, so s+ = (-B + sqrt(discriminant)) / 2A is always the larger root
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = (-B + np.sqrt(np.maximum(discriminant, 0))) / (2 * A)
 
-            if s0 > s1:
-                s = s0
-            else:
-                s = s1
+        # the discriminant can only be negative for a UV source outside the cylinder
+        if self._c_cylinder >= 0:
+            s = np.where(discriminant >= 0, s, 0)
 
         return s
 
     def intersect_with_plane(self):
-        """ calculate intersect of UV photon with pllane -
-            Return the positive path length s+ """
-        if np.linalg.norm(self.tdir) > 1e-10:
-            s = (self.geo.z_plane - self.x0[2]) / self.tdir[2]
-        else:
-            s = 0
+        """ calculate intersect of UV photons with plane -
+            Return the positive path lengths s+ """
+        with np.errstate(divide='ignore'):
+            s = (self.geo.z_plane - self.x0[2]) / self.tdir[:, 2]
         # only positive directions
-        if s < 0:
-            s = 0
-        return s
+        return np.maximum(s, 0)
+
+# -----------------------------------------------------------------------------------#
+if numba is not None:
+    @numba.njit(fastmath=True, cache=True, inline='always')
+    def _trace_photon(ux, uy, uz, x0, z_plane, r_cylinder, tx, ty, c_cylinder, r_sipm2, sipm_xyz,
+                      grid_par, grid_shape, cell_start, cell_sipm, nhit):
+        """ Intersect one photon with plane and cylinder and count its SiPM hits in nhit (length M) """
+        # intersect with plane (only positive directions)
+        s_plane = 0.0
+        if uz != 0.0:
+            s_plane = max((z_plane - x0[2]) / uz, 0.0)
+
+        # intersect with cylinder (positive path length s+)
+        s_cylinder = 0.0
+        A = ux * ux + uy * uy
+        if A > 0.0:
+            B = tx * ux + ty * uy
+            discriminant = B * B - 4 * A * c_cylinder
+            if discriminant >= 0.0:
+                s_cylinder = (-B + sqrt(discriminant)) / (2 * A)
+
+        for k in range(2):
+            s = s_plane if k == 0 else s_cylinder
+            x = x0[0] + s * ux
+            y = x0[1] + s * uy
+            z = x0[2] + s * uz
+
+            # grid cell in which the photon ends
+            nu = grid_shape[k, 0]
+            nv = grid_shape[k, 1]
+            if k == 0:
+                fu = (x - grid_par[k, 0]) / grid_par[k, 2]
+                fv = (y - grid_par[k, 1]) / grid_par[k, 3]
+                if not (fu >= 0.0 and fu < nu):
+                    continue
+            else:
+                fu = (r_cylinder * atan2(y, x) - grid_par[k, 0]) / grid_par[k, 2]
+                fv = (z - grid_par[k, 1]) / grid_par[k, 3]
+            if not (fv >= 0.0 and fv < nv):
+                continue
+            cell = grid_shape[k, 2] + (int(floor(fu)) % nu) * nv + int(fv)
+
+            for c in range(cell_start[cell], cell_start[cell + 1]):
+                j = cell_sipm[c]
+                dx = x - sipm_xyz[j, 0]
+                dy = y - sipm_xyz[j, 1]
+                dz = z - sipm_xyz[j, 2]
+                if dx * dx + dy * dy + dz * dz < r_sipm2:
+                    nhit[j] += 1
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _simulate(tdir, x0, z_plane, r_cylinder, tx, ty, c_cylinder, r_sipm2, sipm_xyz,
+                  grid_par, grid_shape, cell_start, cell_sipm, nhit_out):
+        """ Intersect the photons with plane and cylinder and count the SiPM hits.
+
+            tdir: (n_mc,3) photon directions starting at x0
+            tx, ty, c_cylinder: constants of the photon - cylinder quadratic equation
+            grid_par, grid_shape, cell_start, cell_sipm: SiPMGrid of the SiPMs
+            nhit_out: (n_chunk,M) hit counters, one row for each chunk of photons
+        """
+        n_mc = tdir.shape[0]
+        n_chunk = nhit_out.shape[0]
+        chunk = (n_mc + n_chunk - 1) // n_chunk
+
+        for t in numba.prange(n_chunk):
+            nhit = nhit_out[t]
+            for i in range(t * chunk, min((t + 1) * chunk, n_mc)):
+                _trace_photon(tdir[i, 0], tdir[i, 1], tdir[i, 2], x0, z_plane, r_cylinder, tx, ty,
+                              c_cylinder, r_sipm2, sipm_xyz, grid_par, grid_shape, cell_start, cell_sipm, nhit)
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _simulate_random(n_mc, seeds, cost_min, cost_max, phi_min, phi_max, x0, z_plane, r_cylinder,
+                         tx, ty, c_cylinder, r_sipm2, sipm_xyz, grid_par, grid_shape, cell_start, cell_sipm,
+                         nhit_out, h_cost_out, h_cost_min, h_cost_width):
+        """ Generate n_mc photons with random direction and count the SiPM hits (see _simulate).
+
+            seeds: one seed for each chunk of photons, so the result does not depend on the
+                   number of threads
+            nhit_out: (n_chunk,M) hit counters, one row for each chunk
+            h_cost_out: (n_chunk,n_bin) cos theta histogram with bins of h_cost_width from h_cost_min
+        """
+        n_chunk = len(seeds)
+        chunk = (n_mc + n_chunk - 1) // n_chunk
+        n_bin = h_cost_out.shape[1]
+
+        for t in numba.prange(n_chunk):
+            # the random state belongs to the thread, each chunk restarts it from its own seed
+            np.random.seed(seeds[t])
+            nhit = nhit_out[t]
+            h_cost = h_cost_out[t]
+            for i in range(t * chunk, min((t + 1) * chunk, n_mc)):
+                cost = np.random.uniform(cost_min, cost_max)
+                phi = np.random.uniform(phi_min, phi_max)
+                sint = sqrt(1 - cost * cost)
+                _trace_photon(cos(phi) * sint, sin(phi) * sint, cost, x0, z_plane, r_cylinder, tx, ty,
+                              c_cylinder, r_sipm2, sipm_xyz, grid_par, grid_shape, cell_start, cell_sipm, nhit)
+
+                b = int(floor((cost - h_cost_min) / h_cost_width))
+                if b >= 0 and b < n_bin:
+                    h_cost[b] += 1
+
+# -----------------------------------------------------------------------------------#
+# numba.cuda is only imported when the CUDA backend is used
+_simulate_gpu = None
+
+
+def _cuda_available():
+    """ True if numba.cuda can be imported and finds a GPU """
+    if numba is None:
+        return False
+    try:
+        from numba import cuda
+    except ImportError:
+        return False
+    return cuda.is_available()
+
+
+def _cuda_kernel():
+    """ Return the CUDA kernel _simulate_gpu, defining it on the first call """
+    global _simulate_gpu
+    if _simulate_gpu is not None:
+        return _simulate_gpu
+
+    # cuda and the RNG are closure variables of the kernel, so they stay out of the module namespace.
+    # NOTE: the CUDA simulator (NUMBA_ENABLE_CUDASIM=1) only replaces cuda in the kernel globals
+    #       and cannot run this kernel
+    from numba import cuda
+    from numba.cuda.random import xoroshiro128p_uniform_float64
+
+    @cuda.jit
+    def _simulate_gpu_kernel(n_mc, x0, z_plane, cost_min, cost_max, phi_min, phi_max,
+                             tx, ty, c_cylinder, r_sipm2, sipm_xyz, sipm_is_plane, nhit_out, rng_states):
+        """ GPU version of _simulate: each thread generates its own photons, intersects them
+            with plane and cylinder and hit-tests them against all SiPMs.
+
+            nhit_out: (M,) hit counters, incremented atomically
+        """
+        start = cuda.grid(1)
+        stride = cuda.gridsize(1)
+
+        for i in range(start, n_mc, stride):
+            # generate a UV photon
+            cost = cost_min + (cost_max - cost_min) * xoroshiro128p_uniform_float64(rng_states, start)
+            phi = phi_min + (phi_max - phi_min) * xoroshiro128p_uniform_float64(rng_states, start)
+            sint = sqrt(1 - cost * cost)
+            ux = cos(phi) * sint
+            uy = sin(phi) * sint
+            uz = cost
+
+            # intersect with plane (only positive directions)
+            s_plane = 0.0
+            if uz != 0.0:
+                s_plane = max((z_plane - x0[2]) / uz, 0.0)
+
+            # intersect with cylinder (positive path length s+)
+            s_cylinder = 0.0
+            A = ux * ux + uy * uy
+            if A > 0.0:
+                B = tx * ux + ty * uy
+                discriminant = B * B - 4 * A * c_cylinder
+                if discriminant >= 0.0:
+                    s_cylinder = (-B + sqrt(discriminant)) / (2 * A)
+
+            for j in range(sipm_xyz.shape[0]):
+                s = s_plane if sipm_is_plane[j] else s_cylinder
+                dx = x0[0] + s * ux - sipm_xyz[j, 0]
+                dy = x0[1] + s * uy - sipm_xyz[j, 1]
+                dz = x0[2] + s * uz - sipm_xyz[j, 2]
+                if dx * dx + dy * dy + dz * dz < r_sipm2:
+                    cuda.atomic.add(nhit_out, j, 1)
+
+    _simulate_gpu = _simulate_gpu_kernel
+    return _simulate_gpu
 
 # -----------------------------------------------------------------------------------#
 class Reconstruction:
-    def __init__(self, sim):
+    def __init__(self, sim, **kwargs):
         self.sim = sim
         self.geo = sim.geo
+        # random number generator for the emulated events (seed = None: not reproducible)
+        self.rng = np.random.default_rng(kwargs.pop('seed', None))
 
     def generate_hit(self, nuv):
         # generate a hit based on the simulated response for a give position
@@ -272,12 +697,20 @@ class Reconstruction:
         # appropriate statistical fluctuations
 
         self.nmeasured = []
-        for sipm in self.geo.get_sipms():
-            nexp = nuv * sipm.get_hit_probability()
-            sipm.set_number_of_hits(np.random.poisson(nexp))
+        counts = self.rng.poisson(nuv * self.hit_probabilities())
+        self.set_hits(counts)
 
         return 0
 
+    def hit_probabilities(self):
+        """Array with the simulated hit probability of every SiPM"""
+        return np.array([sipm.get_hit_probability() for sipm in self.geo.get_sipms()])
+
+    def set_hits(self, counts):
+        """Set the number of detected photons of every SiPM from an array of length M"""
+        for sipm, n in zip(self.geo.get_sipms(), counts):
+            sipm.set_number_of_hits(int(n))
+
     def reconstruct_position(self, method):
         self.rate0 = 0
         self.xrec = [0, 0, 0]
@@ -288,14 +721,15 @@ class Reconstruction:
 
         self.method = method
         if method == "COG":
-            n = 0
-            xs = [0, 0, 0]
-            for sipm in self.geo.get_sipms():
-                xs = xs + np.multiply(sipm.get_location(), sipm.get_number_of_hits())
-                n = n + sipm.get_number_of_hits()
-            self.xrec = xs / n
+            n = np.array([sipm.get_number_of_hits() for sipm in self.geo.get_sipms()])
             self.rate0 = -1
-            self.status = 1
+            if n.sum() > 0:
+                self.xrec = np.average(self.geo.xyz, weights=n, axis=0)
+                self.status = 1
+            else:
+                # no photons detected
+                self.xrec = [-999, -999, -999]
+                self.status = 0
 
         else:  # model fit
             errordef = 0.0
@@ -306,9 +740,10 @@ class Reconstruction:
             else:
                 print("Reconstruction::reconstruct_position() ERROR bad value of errordef:", errordef)
 
-            self.lnlike = PosFit(self.geo.get_sipms(), method)
+            self.lnlike = PosFit(self.geo, method)
             n0 = 1000
             m = Minuit(self.lnlike,
+                       grad=self.lnlike.grad,
                        rate0=n0,
                        xpos=25.,
                        ypos=25.,
@@ -324,7 +759,7 @@ class Reconstruction:
             # print(m_status)
             if m_status[0].has_accurate_covar:
                 # m.minos()
-                m.migrad()
+                # the fit has converged: the values are read directly (no second migrad)
 
                 fval = m_status[0].fval
                 self.rate0 = m.values['rate0'] * 4 * np.pi / self.geo.a_sipm
@@ -365,7 +800,11 @@ class Reconstruction:
         nbins = kwargs.pop('nbins',15)
         plot_range = kwargs.pop('range',None)
 
-        self.df_rec = pd.DataFrame()
+        self._rec_rows = []
+
+        # number of detected photons on each SiPM for all events
+        p = self.hit_probabilities()
+        all_counts = self.rng.poisson(n_uv * p, size=(n_event, len(p)))
 
         for self.i_event in range(n_event):
 
@@ -374,12 +813,12 @@ class Reconstruction:
             #
             # emuate one event
             #
-            self.generate_hit(nuv=n_uv)
+            self.set_hits(all_counts[self.i_event])
             #
             # fit the position of the emulated event
             #
             result = self.reconstruct_position(method=method)
-            self.df_rec = self.df_rec.append(result, ignore_index=True)
+            self._rec_rows.append(result)
 
             #
             # plot the likelihood function
@@ -388,12 +827,16 @@ class Reconstruction:
                 self.event_display(nbins=nbins,range=plot_range)
                 istat = int(input("Type: 0 to quit, 1 to continue, 2 to make pdf...."))
                 if  istat == 0:
+                    self.df_rec = pd.DataFrame.from_records(self._rec_rows)
                     return self.df_rec
                 elif istat == 2:
                     self.generate_pdf()
 
+                from IPython.display import clear_output
                 clear_output()
 
+        self.df_rec = pd.DataFrame.from_records(self._rec_rows)
+
         # print(df)
         print("reconstruction done")
 
@@ -407,6 +850,9 @@ class Reconstruction:
     def event_display(self, **kwargs):
         """event_display. Display of fit and log(L) or chi2 for singe events.
         Use this (long) function) to understand details of the fit procedure"""
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import BoundaryNorm
+        from matplotlib.ticker import MaxNLocator
 
         plot_range = kwargs.pop('range',None)
         nbins = kwargs.pop('nbins',15)
@@ -446,28 +892,25 @@ class Reconstruction:
         self.ax0.set_title(title_string)
 
         # add the SiPMs
-        mx_eff = -1
-        for sipm in self.geo.get_sipms():
-            if sipm.get_number_of_hits() > mx_eff:
-                mx_eff = sipm.get_number_of_hits()
+        n = np.array([sipm.get_number_of_hits() for sipm in self.geo.get_sipms()])
+        mx_eff = n.max(initial=-1)
 
-        for sipm in self.geo.get_sipms():
-            # draw location of SiPM
-            xs = sipm.get_location()
-
-            # plot SiPM only if in range
-            if (xs[0]>plot_range[0][0]) & (xs[0]<plot_range[0][1]) & \
-                    (xs[1]>plot_range[1][0]) & (xs[1]<plot_range[1][1]):
+        # plot SiPM only if in range
+        xyz = self.geo.xyz
+        in_range = (xyz[:, 0] > plot_range[0][0]) & (xyz[:, 0] < plot_range[0][1]) & \
+                   (xyz[:, 1] > plot_range[1][0]) & (xyz[:, 1] < plot_range[1][1])
 
-                dx = sipm.get_number_of_hits() / mx_eff * 5
-                sq = plt.Rectangle(xy=(xs[0] - dx / 2, xs[1] - dx / 2),
-                                   height=dx,
-                                   width=dx,
-                                   fill=False, color='red')
-                self.ax0.add_artist(sq)
-                # write number of detected photons
-                txs = str(sipm.get_number_of_hits())
-                plt.text(xs[0]+dx/2+2.5,xs[1],txs,color='red')
+        for xs, nhit in zip(xyz[in_range], n[in_range]):
+            # draw location of SiPM
+            dx = nhit / mx_eff * 5
+            sq = plt.Rectangle(xy=(xs[0] - dx / 2, xs[1] - dx / 2),
+                               height=dx,
+                               width=dx,
+                               fill=False, color='red')
+            self.ax0.add_artist(sq)
+            # write number of detected photons
+            txs = str(nhit)
+            plt.text(xs[0]+dx/2+2.5,xs[1],txs,color='red')
 
 
         plt.xlabel('x (mm)', fontsize=18)
@@ -482,6 +925,8 @@ class Reconstruction:
 
     def plot(self, type, **kwargs):
         """Draw plots"""
+        import matplotlib.pyplot as plt
+
         range = kwargs.pop('range', None)
         bins = kwargs.pop('bins', 100)
         # cut on the fit quality
@@ -550,85 +995,185 @@ class Reconstruction:
 
 # -----------------------------------------------------------------------------------#
 class PosFit:
-    def __init__(self, sipms, method):
+    def __init__(self, geo, method):
         self.method = method
-        self.sipms = sipms
-        # coordinates of the sipm
-        self.xs = []
-        self.ys = []
-        self.zs = []
-        self.err = []
-        self.n = []
-
-        for sipm in self.sipms:
-
-            if sipm.get_number_of_hits() > -1:
-                self.xs.append(sipm.get_location())
-                self.n.append(sipm.get_number_of_hits())
-                self.err.append(1)
+        self.sipms = geo.get_sipms()
+
+        n = np.array([sipm.get_number_of_hits() for sipm in self.sipms], dtype=np.int64)
+        use = n > -1
+
+        # coordinates, normal vectors and quantum efficiencies of the sipms
+        self.xs_arr = geo.xyz[use]
+        self.nhat = geo.nhat[use]
+        self.qe = geo.qe[use]
+        # number of observed events
+        self.n = n[use]
+        self.n_arr = self.n.astype(np.float64)
+        # ln(N!) does not change during the fit
+        self._ln_nfac = gammaln(self.n_arr + 1.0)
+        # compiled likelihood / chi2 and gradient for scalar arguments (None without numba)
+        self._eval = self._make_eval()
+        self._grad_eval = self._make_grad_eval()
+
+    def _make_eval(self):
+        if numba is None:
+            return None
+        elif self.method == "CHI2":
+            return _posfit_chi2
+        elif self.method == "LNLIKE":
+            return _posfit_lnlike
+        return None
+
+    def _make_grad_eval(self):
+        if numba is None:
+            return None
+        elif self.method == "CHI2":
+            return _posfit_chi2_grad
+        elif self.method == "LNLIKE":
+            return _posfit_lnlike_grad
+        return None
 
     def __call__(self, rate0, xpos, ypos):
         #
         # calculate log likelihood / chi2 for position reconstruction
         #
-        lnlike = 0
+        # xpos and ypos may also be arrays (e.g. a grid for the event display),
+        # in which case an array of the same shape is returned
+        #
+        if self._eval is not None and np.ndim(xpos) == 0 and np.ndim(ypos) == 0:
+            return self._eval(float(rate0), float(xpos), float(ypos),
+                              self.xs_arr, self.nhat, self.qe, self.n_arr, self._ln_nfac)
 
-        for i in range(len(self.n)):
-            #
-            # calculate the number of expected photons
-            #
-            nexpected = self.nexp(rate0, xpos, ypos, i)
-            #
-            # number of oserved events
-            #
-            N = self.n[i]
+        nexpected = self.nexp(rate0, xpos, ypos)
 
+        if self.method == "CHI2":
+            res = self.n_arr - nexpected
+            lnlike = np.sum(res * res / nexpected, axis=-1)
 
-            if self.method == "CHI2":
-                res = self.n[i] - nexpected
-                # lnlike = lnlike+res*res / (self.err[i]*self.err[i])
-                #if nexpected > 1e-6:
-                lnlike = lnlike + res * res / nexpected
-                #lnlike = lnlike + res * res / self.n[i]
+        elif self.method == "LNLIKE":
+            lnp = -nexpected + self.n_arr * np.log(nexpected) - self._ln_nfac
+            lnlike = -np.sum(lnp, axis=-1)
+        else:
+            print("PosRec::BAD METHOD for position reconstruction. method =", self.method)
+            lnlike = 0
 
+        return lnlike
 
-                #if self.n[i] > 0:
-                #   lnlike = lnlike + res * res / self.nexp
-                #else:
-                #    lnlike = lnlike + res * res / self.nexp
+    def nexp(self, rate0, xpos, ypos):
+        """Calculate the expected number of photons hitting each SiPM"""
 
-            elif self.method == "LNLIKE":
+        xfit = np.stack(np.broadcast_arrays(xpos, ypos, 0.), axis=-1)
+        delta = self.xs_arr - xfit[..., None, :]
 
-                if (N < 100):  # exact calculation
-                    ln_nfac = np.log(1. * np.math.factorial(N))
-                else:  # Stirling approximation for large N
-                    ln_nfac = N * np.log(1. * N) - N
+        dist2 = np.einsum('...ij,...ij->...i', delta, delta)
+        dist = np.sqrt(dist2)
 
-                lnp = -nexpected + N * np.log(nexpected) - ln_nfac
+        # correct for the slid angle of the sensor
+        cost = np.abs(np.einsum('...ij,ij->...i', delta, self.nhat)) / dist
 
-                lnlike = lnlike - lnp
-            else:
-                print("PosRec::BAD METHOD for position reconstruction. method =", self.method)
+        # expected number of events (corrected for the quantum efficiency)
+        yy = rate0 / dist2 * cost * self.qe
+        return yy
 
-        return lnlike
+    def grad(self, rate0, xpos, ypos):
+        """Analytic gradient (dL/drate0, dL/dxpos, dL/dypos) of the log likelihood / chi2"""
 
-    def nexp(self, rate0, xpos, ypos, i):
-        """Calculate the expected number of photons hitting a SiPM"""
+        if self._grad_eval is not None:
+            return self._grad_eval(float(rate0), float(xpos), float(ypos),
+                                   self.xs_arr, self.nhat, self.qe, self.n_arr)
 
-        xfit = np.array([xpos,ypos,0])
-        delta = np.array(self.xs[i]) - xfit
+        delta = self.xs_arr - np.array([xpos, ypos, 0.])
+        dist2 = np.einsum('ij,ij->i', delta, delta)
 
-        dist = np.linalg.norm(delta)
-        dist2 = dist**2
+        # nexp = rate0 * qe * |delta.nhat| / dist^3
+        proj = np.einsum('ij,ij->i', delta, self.nhat)
+        cost = np.abs(proj)
+        f = self.qe / (dist2 * np.sqrt(dist2))
+        nexpected = rate0 * f * cost
 
-        # correct for the slid angle of the sensor
-        cost = abs(np.dot(delta, self.sipms[i].get_normal_vector())/dist)
+        # derivative of the expected number of events (d delta / dxpos = (-1, 0, 0) etc.)
+        dn_drate0 = f * cost
+        dn_dxpos = rate0 * f * (3 * cost * delta[:, 0] / dist2 - np.sign(proj) * self.nhat[:, 0])
+        dn_dypos = rate0 * f * (3 * cost * delta[:, 1] / dist2 - np.sign(proj) * self.nhat[:, 1])
 
-        # quantum efficiency
-        qe = self.sipms[i].qe
+        # derivative of the log likelihood / chi2 with respect to the expected number of events
+        if self.method == "CHI2":
+            dl_dn = 1 - self.n_arr * self.n_arr / (nexpected * nexpected)
+        elif self.method == "LNLIKE":
+            dl_dn = 1 - self.n_arr / nexpected
+        else:
+            print("PosRec::BAD METHOD for position reconstruction. method =", self.method)
+            dl_dn = np.zeros_like(nexpected)
+
+        return np.array([np.sum(dl_dn * dn_drate0), np.sum(dl_dn * dn_dxpos), np.sum(dl_dn * dn_dypos)])
 
-        # expected number of events
-        yy = rate0 / dist2 * cost * qe
-        return yy
 
-    
+# -----------------------------------------------------------------------------------#
+if numba is not None:
+    @numba.njit(cache=True)
+    def _posfit_nexp(rate0, xpos, ypos, xs, nhat, qe, i):
+        """Expected number of photons hitting SiPM i (see PosFit.nexp)"""
+        dx = xs[i, 0] - xpos
+        dy = xs[i, 1] - ypos
+        dz = xs[i, 2]
+        dist2 = dx * dx + dy * dy + dz * dz
+        cost = abs(dx * nhat[i, 0] + dy * nhat[i, 1] + dz * nhat[i, 2]) / sqrt(dist2)
+        return rate0 / dist2 * cost * qe[i]
+
+    @numba.njit(cache=True)
+    def _posfit_dnexp(rate0, xpos, ypos, xs, nhat, qe, i):
+        """Expected number of photons hitting SiPM i and its derivatives (see PosFit.grad)"""
+        dx = xs[i, 0] - xpos
+        dy = xs[i, 1] - ypos
+        dz = xs[i, 2]
+        dist2 = dx * dx + dy * dy + dz * dz
+        proj = dx * nhat[i, 0] + dy * nhat[i, 1] + dz * nhat[i, 2]
+        sign = 1.0 if proj > 0 else (-1.0 if proj < 0 else 0.0)
+        cost = abs(proj)
+        f = qe[i] / (dist2 * sqrt(dist2))
+        dn_dxpos = rate0 * f * (3 * cost * dx / dist2 - sign * nhat[i, 0])
+        dn_dypos = rate0 * f * (3 * cost * dy / dist2 - sign * nhat[i, 1])
+        return rate0 * f * cost, f * cost, dn_dxpos, dn_dypos
+
+    @numba.njit(cache=True)
+    def _posfit_chi2_grad(rate0, xpos, ypos, xs, nhat, qe, n):
+        """PosFit chi2 gradient for scalar arguments"""
+        g = np.zeros(3)
+        for i in range(len(n)):
+            nexpected, dn_drate0, dn_dxpos, dn_dypos = _posfit_dnexp(rate0, xpos, ypos, xs, nhat, qe, i)
+            dl_dn = 1 - n[i] * n[i] / (nexpected * nexpected)
+            g[0] += dl_dn * dn_drate0
+            g[1] += dl_dn * dn_dxpos
+            g[2] += dl_dn * dn_dypos
+        return g
+
+    @numba.njit(cache=True)
+    def _posfit_lnlike_grad(rate0, xpos, ypos, xs, nhat, qe, n):
+        """PosFit -log likelihood gradient for scalar arguments"""
+        g = np.zeros(3)
+        for i in range(len(n)):
+            nexpected, dn_drate0, dn_dxpos, dn_dypos = _posfit_dnexp(rate0, xpos, ypos, xs, nhat, qe, i)
+            dl_dn = 1 - n[i] / nexpected
+            g[0] += dl_dn * dn_drate0
+            g[1] += dl_dn * dn_dxpos
+            g[2] += dl_dn * dn_dypos
+        return g
+
+    @numba.njit(cache=True)
+    def _posfit_chi2(rate0, xpos, ypos, xs, nhat, qe, n, ln_nfac):
+        """PosFit chi2 for scalar arguments"""
+        chi2 = 0.0
+        for i in range(len(n)):
+            nexpected = _posfit_nexp(rate0, xpos, ypos, xs, nhat, qe, i)
+            res = n[i] - nexpected
+            chi2 += res * res / nexpected
+        return chi2
+
+    @numba.njit(cache=True)
+    def _posfit_lnlike(rate0, xpos, ypos, xs, nhat, qe, n, ln_nfac):
+        """PosFit -log likelihood for scalar arguments"""
+        lnlike = 0.0
+        for i in range(len(n)):
+            nexpected = _posfit_nexp(rate0, xpos, ypos, xs, nhat, qe, i)
+            lnlike -= -nexpected + n[i] * np.log(nexpected) - ln_nfac[i]
+        return lnlike